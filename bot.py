@@ -7,50 +7,47 @@ Discord бот для автоматического снятия роли че
 
 import os
 import sys
+import atexit
+import queue
+import asyncio
 import logging
 import logging.handlers
 from pathlib import Path
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 import sqlite3
 import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import time
+from aiohttp import web
 import discord
 from discord.ext import commands, tasks
 
 # ==================== 0. HEALTH CHECK СЕРВЕР (для Render Web Service) ====================
-import os
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import threading
+# aiohttp-сервер работает в том же event loop, что и бот, — без отдельного потока
+async def health_handler(request: web.Request) -> web.Response:
+    return web.Response(text="✅ Бот работает\n")
 
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/health' or self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain; charset=utf-8')
-            self.end_headers()
-            self.wfile.write("✅ Бот работает\n".encode('utf-8'))
-        else:
-            self.send_response(404)
-            self.end_headers()
-    
-    def log_message(self, format, *args):
-        pass  # Не засоряем логи
-
-def start_health_server():
+async def start_health_server():
     """Запускаем сервер на порту из переменной окружения PORT (обязательно для Render)"""
     port = int(os.environ.get("PORT", "8000"))  # 🔑 Render сам устанавливает PORT
     try:
-        server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
+        app = web.Application()
+        app.router.add_get("/", health_handler)
+        app.router.add_get("/health", health_handler)
+        runner = web.AppRunner(app, access_log=None)  # Не засоряем логи
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", port).start()
         logger.info(f"✅ Health server запущен на порту {port} (Render PORT={port})")
-        server.serve_forever()
+        return runner
     except Exception as e:
         logger.error(f"❌ Ошибка запуска health server: {e}")
+        return None
 
 # ==================== 1. НАСТРОЙКА ЛОГИРОВАНИЯ ====================
 Path("logs").mkdir(exist_ok=True)
 
 logger = logging.getLogger("role_manager_bot")
-logger.setLevel(logging.DEBUG)
+# По умолчанию INFO; подробный вывод включается через LOG_LEVEL=DEBUG
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 
 formatter = logging.Formatter(
     '%(asctime)s | %(levelname)-8s | %(message)s',
@@ -59,7 +56,6 @@ formatter = logging.Formatter(
 
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
 
 file_handler = logging.handlers.RotatingFileHandler(
     "logs/bot.log",
@@ -68,141 +64,342 @@ file_handler = logging.handlers.RotatingFileHandler(
     encoding="utf-8"
 )
 file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+
+# Запись в консоль и файл (с ротацией) делает фоновый поток QueueListener,
+# а event loop только кладёт запись в очередь
+log_queue = queue.SimpleQueue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+log_listener = logging.handlers.QueueListener(
+    log_queue, console_handler, file_handler, respect_handler_level=True
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger.addHandler(queue_handler)
 
 discord_logger = logging.getLogger('discord')
 discord_logger.setLevel(logging.WARNING)
-discord_logger.addHandler(console_handler)
-discord_logger.addHandler(file_handler)
+discord_logger.addHandler(queue_handler)
 
 # ==================== 2. НАСТРОЙКИ ====================
 ROLE_ID_TO_TRACK = int(os.getenv("ROLE_ID", "1470909799502712935"))
-CHECK_INTERVAL_MINUTES = 5
+RETRY_MIN_MINUTES = 1            # Первый повтор для записей, которые не удалось обработать
+RETRY_MAX_MINUTES = 30           # Потолок повтора: интервал удваивается, пока ошибки не исчезнут
 HOURS_UNTIL_REMOVAL = 24
+IDLE_SLEEP_HOURS = HOURS_UNTIL_REMOVAL  # Сон при пустой БД: запись, добавленная за это время, истечёт не раньше пробуждения
+DB_OPTIMIZE_INTERVAL_HOURS = 6   # Как часто обновлять статистику планировщика (PRAGMA optimize)
+MAX_CONCURRENT_REMOVALS = 10     # Сколько ролей снимать параллельно за одну проверку
+EXPIRED_BATCH_LIMIT = 500        # Сколько истёкших записей брать за одну пачку
+SEND_DM_ON_REMOVE = os.getenv("DM_ON_REMOVE", "0") == "1"  # ЛС о снятии роли (по умолчанию выкл.)
+AUDIT_LOG_LIMIT = 5              # Сколько записей Audit Log запрашивать за раз
+AUDIT_CACHE_TTL_SECONDS = 30     # Сколько секунд переиспользовать выборку Audit Log
+MEMBER_QUERY_CHUNK = 100         # Максимум ID в одном query_members (лимит Discord)
 
 if ROLE_ID_TO_TRACK == 0:
     logger.error("❌ Не указан ROLE_ID в переменных окружения! Остановка бота.")
     sys.exit(1)
 
 # ==================== 3. БАЗА ДАННЫХ С МИГРАЦИЕЙ ====================
+# SQL вынесен в константы: одинаковый текст запроса попадает в кэш
+# подготовленных выражений sqlite3 и не компилируется заново
+# UPSERT обновляет строку на месте (INSERT OR REPLACE удалял бы и вставлял её заново)
+SQL_INSERT = """
+    INSERT INTO pending_roles
+    (user_id, guild_id, role_id, assigned_at, assigned_by)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, guild_id, role_id) DO UPDATE SET
+        assigned_at = excluded.assigned_at,
+        assigned_by = excluded.assigned_by
+"""
+SQL_DELETE = """
+    DELETE FROM pending_roles
+    WHERE user_id = ? AND guild_id = ? AND role_id = ?
+"""
+# Пакетное удаление истёкших строк по rowid (поиск по B-дереву, без скана).
+# Условие на assigned_at защищает роль, выданную заново за время проверки
+SQL_DELETE_ROWIDS = """
+    DELETE FROM pending_roles
+    WHERE rowid IN ({placeholders}) AND assigned_at < ?
+"""
+DELETE_BATCH_SIZE = 900  # укладываемся в лимит SQLite в 999 параметров
+SQL_STATEMENT_CACHE_SIZE = 256  # подготовленных запросов на соединение (по умолчанию 128)
+# Постраничная выборка по ключу (assigned_at, rowid): следующая пачка начинается
+# после последней строки предыдущей, а не снова с самых старых записей
+SQL_EXPIRED = """
+    SELECT rowid, user_id, guild_id, role_id, assigned_at, assigned_by
+    FROM pending_roles
+    WHERE assigned_at < ? AND (assigned_at, rowid) > (?, ?)
+    ORDER BY assigned_at, rowid
+    LIMIT ?
+"""
+# MIN отдельным подзапросом — это один шаг по индексу assigned_at
+SQL_STATS = """
+    SELECT (SELECT COUNT(*) FROM pending_roles),
+           (SELECT MIN(assigned_at) FROM pending_roles)
+"""
+SQL_NEXT_EXPIRY = "SELECT MIN(assigned_at) FROM pending_roles WHERE assigned_at >= ?"
+
 class Database:
+    """Синхронная обёртка над SQLite. Из асинхронного кода методы вызываются
+    через asyncio.to_thread, чтобы запись на диск не блокировала event loop."""
     def __init__(self, path="roles.db"):
         self.path = path
+        # Одно долгоживущее соединение вместо connect/close на каждый запрос.
+        # Доступ из cog и из потоков сериализуем через lock.
+        self._lock = threading.Lock()
+        # Кэш (count, oldest) для !статус; сбрасывается при любой записи
+        self._stats = None
+        # SQL — константы модуля, так что подготовленные запросы берутся из кэша соединения;
+        # запас под DELETE ... IN (?, ...) с разным числом параметров
+        self.conn = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False,
+            cached_statements=SQL_STATEMENT_CACHE_SIZE
+        )
+        # WAL + synchronous=NORMAL: один fsync на checkpoint вместо двух на каждую запись
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-64000")     # ~64 МБ кэша страниц на соединение
+        self.conn.execute("PRAGMA mmap_size=268435456")   # 256 МБ — БД читается из памяти
+        self.conn.execute("PRAGMA wal_autocheckpoint=2000")  # реже останавливаемся на checkpoint
         self.init_db()
     
     def init_db(self):
         try:
-            conn = sqlite3.connect(self.path)
-            cursor = conn.cursor()
-            
-            # Создаём таблицу если не существует
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS pending_roles (
-                    user_id INTEGER NOT NULL,
-                    guild_id INTEGER NOT NULL,
-                    role_id INTEGER NOT NULL,
-                    assigned_at TEXT NOT NULL,
-                    assigned_by TEXT NOT NULL DEFAULT 'unknown',
-                    PRIMARY KEY (user_id, guild_id, role_id)
+            with self._lock:
+                cursor = self.conn.cursor()
+                
+                # Создаём таблицу если не существует
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS pending_roles (
+                        user_id INTEGER NOT NULL,
+                        guild_id INTEGER NOT NULL,
+                        role_id INTEGER NOT NULL,
+                        assigned_at INTEGER NOT NULL,
+                        assigned_by TEXT NOT NULL DEFAULT 'unknown',
+                        PRIMARY KEY (user_id, guild_id, role_id)
+                    )
+                """)
+                
+                # === МИГРАЦИЯ: добавляем колонку assigned_by если её нет ===
+                # Проверяем структуру таблицы
+                cursor.execute("PRAGMA table_info(pending_roles)")
+                columns = [col[1] for col in cursor.fetchall()]
+                
+                if 'assigned_by' not in columns:
+                    logger.info("🔧 Обнаружена старая структура БД — запускаем миграцию...")
+                    # Добавляем колонку с временным значением по умолчанию
+                    cursor.execute("ALTER TABLE pending_roles ADD COLUMN assigned_by TEXT NOT NULL DEFAULT 'migrated'")
+                    logger.info("✅ Колонка assigned_by успешно добавлена через миграцию")
+                else:
+                    logger.debug("ℹ️  Колонка assigned_by уже существует в БД")
+                
+                # === МИГРАЦИЯ: assigned_at из ISO-строки в INTEGER (Unix-время) ===
+                # Тип колонки в SQLite не меняется через ALTER — пересоздаём таблицу
+                cursor.execute("PRAGMA table_info(pending_roles)")
+                column_types = {col[1]: col[2].upper() for col in cursor.fetchall()}
+                
+                if column_types.get('assigned_at') != 'INTEGER':
+                    logger.info("🔧 assigned_at хранится как текст — конвертируем в Unix-время...")
+                    cursor.execute("BEGIN IMMEDIATE")
+                    try:
+                        cursor.execute("""
+                            CREATE TABLE pending_roles_new (
+                                user_id INTEGER NOT NULL,
+                                guild_id INTEGER NOT NULL,
+                                role_id INTEGER NOT NULL,
+                                assigned_at INTEGER NOT NULL,
+                                assigned_by TEXT NOT NULL DEFAULT 'unknown',
+                                PRIMARY KEY (user_id, guild_id, role_id)
+                            )
+                        """)
+                        # Битые даты считаем выданными сейчас — роль снимется через полный срок
+                        cursor.execute("""
+                            INSERT OR REPLACE INTO pending_roles_new
+                            (user_id, guild_id, role_id, assigned_at, assigned_by)
+                            SELECT user_id, guild_id, role_id,
+                                   COALESCE(CAST(strftime('%s', assigned_at) AS INTEGER),
+                                            CAST(strftime('%s', 'now') AS INTEGER)),
+                                   assigned_by
+                            FROM pending_roles
+                        """)
+                        cursor.execute("DROP TABLE pending_roles")
+                        cursor.execute("ALTER TABLE pending_roles_new RENAME TO pending_roles")
+                        cursor.execute("COMMIT")
+                    except Exception:
+                        cursor.execute("ROLLBACK")
+                        raise
+                    logger.info("✅ Колонка assigned_at переведена в INTEGER")
+                
+                # Индекс для выборки истёкших ролей: range scan вместо полного прохода
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_pending_assigned_at ON pending_roles(assigned_at)"
                 )
-            """)
-            
-            # === МИГРАЦИЯ: добавляем колонку assigned_by если её нет ===
-            # Проверяем структуру таблицы
-            cursor.execute("PRAGMA table_info(pending_roles)")
-            columns = [col[1] for col in cursor.fetchall()]
-            
-            if 'assigned_by' not in columns:
-                logger.info("🔧 Обнаружена старая структура БД — запускаем миграцию...")
-                # Добавляем колонку с временным значением по умолчанию
-                cursor.execute("ALTER TABLE pending_roles ADD COLUMN assigned_by TEXT NOT NULL DEFAULT 'migrated'")
-                logger.info("✅ Колонка assigned_by успешно добавлена через миграцию")
-            else:
-                logger.debug("ℹ️  Колонка assigned_by уже существует в БД")
+                
+                # Статистика для планировщика запросов — собираем один раз, если её ещё нет
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+                if cursor.fetchone() is None:
+                    cursor.execute("ANALYZE")
+                    logger.debug("ℹ️  Собрана статистика ANALYZE")
             
-            conn.commit()
-            conn.close()
             logger.info(f"✅ База данных инициализирована: {self.path}")
         except Exception as e:
             logger.exception(f"❌ Ошибка инициализации БД: {e}")
             raise
     
+    def close(self):
+        with self._lock:
+            try:
+                self.conn.execute("PRAGMA optimize")
+            except Exception as e:
+                logger.warning(f"⚠️  PRAGMA optimize при закрытии БД не выполнен: {e}")
+            self.conn.close()
+    
+    def optimize(self):
+        """Обновляет статистику планировщика запросов (дёшево, если ничего не изменилось)"""
+        try:
+            with self._lock:
+                self.conn.execute("PRAGMA optimize")
+        except Exception as e:
+            logger.exception(f"❌ Ошибка PRAGMA optimize: {e}")
+    
+    def checkpoint(self):
+        """Переносит WAL в основной файл БД и обрезает WAL до нуля"""
+        try:
+            with self._lock:
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            logger.exception(f"❌ Ошибка WAL checkpoint: {e}")
+    
     def add_role(self, user_id: int, guild_id: int, role_id: int, assigned_by: str):
         try:
-            conn = sqlite3.connect(self.path)
-            cursor = conn.cursor()
-            now = datetime.now(timezone.utc).isoformat()
-            cursor.execute("""
-                INSERT OR REPLACE INTO pending_roles 
-                (user_id, guild_id, role_id, assigned_at, assigned_by)
-                VALUES (?, ?, ?, ?, ?)
-            """, (user_id, guild_id, role_id, now, assigned_by))
-            conn.commit()
-            conn.close()
-            logger.info(f"➕ Роль {role_id} добавлена для пользователя {user_id} (выдал: {assigned_by})")
+            now = int(time.time())
+            with self._lock:
+                self.conn.execute(SQL_INSERT, (user_id, guild_id, role_id, now, assigned_by))
+                self._stats = None
+            logger.info("➕ Роль %s добавлена для пользователя %s (выдал: %s)", role_id, user_id, assigned_by)
         except Exception as e:
             logger.exception(f"❌ Ошибка добавления роли в БД: {e}")
     
     def remove_role_record(self, user_id: int, guild_id: int, role_id: int):
         try:
-            conn = sqlite3.connect(self.path)
-            cursor = conn.cursor()
-            cursor.execute("""
-                DELETE FROM pending_roles 
-                WHERE user_id = ? AND guild_id = ? AND role_id = ?
-            """, (user_id, guild_id, role_id))
-            changed = cursor.rowcount
-            conn.commit()
-            conn.close()
+            with self._lock:
+                changed = self.conn.execute(SQL_DELETE, (user_id, guild_id, role_id)).rowcount
+                self._stats = None
             if changed:
-                logger.info(f"➖ Запись удалена для пользователя {user_id}, роль {role_id}")
+                logger.info("➖ Запись удалена для пользователя %s, роль %s", user_id, role_id)
             return changed
         except Exception as e:
             logger.exception(f"❌ Ошибка удаления записи из БД: {e}")
             return 0
     
-    def get_expired_roles(self, hours: int = 24):
+    def remove_expired_rows(self, rowids, hours: int = 24):
+        """Удаляет истёкшие записи по rowid из get_expired_roles одной транзакцией,
+        по одному DELETE ... IN (...) на каждые DELETE_BATCH_SIZE строк"""
+        if not rowids:
+            return 0
         try:
-            conn = sqlite3.connect(self.path)
-            cursor = conn.cursor()
-            expiry_time = (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat()
-            cursor.execute("""
-                SELECT user_id, guild_id, role_id, assigned_at, assigned_by 
-                FROM pending_roles 
-                WHERE assigned_at < ?
-            """, (expiry_time,))
-            results = cursor.fetchall()
-            conn.close()
-            logger.debug(f"📊 Найдено {len(results)} истёкших ролей (порог: {hours}ч)")
+            changed = 0
+            expiry_time = int(time.time()) - hours * 3600
+            with self._lock:
+                with self.conn:
+                    # IMMEDIATE: блокировка записи берётся сразу, а не на первом DELETE
+                    self.conn.execute("BEGIN IMMEDIATE")
+                    for start in range(0, len(rowids), DELETE_BATCH_SIZE):
+                        batch = rowids[start:start + DELETE_BATCH_SIZE]
+                        sql = SQL_DELETE_ROWIDS.format(placeholders=", ".join("?" * len(batch)))
+                        changed += self.conn.execute(sql, (*batch, expiry_time)).rowcount
+                self._stats = None
+            logger.info("➖ Удалено записей из БД: %d", changed)
+            return changed
+        except Exception as e:
+            logger.exception(f"❌ Ошибка пакетного удаления записей из БД: {e}")
+            return 0
+    
+    def get_expired_roles(self, cutoff: int, after=(-1, 0), limit: int = EXPIRED_BATCH_LIMIT):
+        """Записи с assigned_at < cutoff, идущие после ключа after = (assigned_at, rowid),
+        не больше limit за раз"""
+        try:
+            with self._lock:
+                results = self.conn.execute(SQL_EXPIRED, (cutoff, *after, limit)).fetchall()
+            logger.debug("📊 Найдено %d истёкших ролей (порог: %d)", len(results), cutoff)
             return results
         except Exception as e:
             logger.exception(f"❌ Ошибка получения истёкших ролей из БД: {e}")
             return []
     
+    def get_next_expiry(self, cutoff: int, hours: int = 24):
+        """Unix-время, когда истечёт ближайшая запись, не попавшая под cutoff (None — таких нет).
+        cutoff — тот же порог, что использовал проход, иначе записи, истёкшие
+        во время прохода, не попадут ни в выборку, ни сюда"""
+        try:
+            with self._lock:
+                (oldest,) = self.conn.execute(SQL_NEXT_EXPIRY, (cutoff,)).fetchone()
+            return None if oldest is None else oldest + hours * 3600
+        except Exception as e:
+            logger.exception(f"❌ Ошибка получения ближайшего истечения из БД: {e}")
+            return None
+    
     def get_all_pending(self):
         try:
-            conn = sqlite3.connect(self.path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*), MIN(assigned_at) FROM pending_roles")
-            count, oldest = cursor.fetchone()
-            conn.close()
+            with self._lock:
+                if self._stats is None:
+                    self._stats = self.conn.execute(SQL_STATS).fetchone()
+                count, oldest = self._stats
             return count, oldest
         except Exception as e:
             logger.exception(f"❌ Ошибка получения статистики из БД: {e}")
             return 0, None
+    
+    def clear_all(self):
+        """Очищает таблицу. DELETE без WHERE в режиме autocommit SQLite выполняет
+        через truncate-оптимизацию (страницы освобождаются целиком, без обхода строк)"""
+        try:
+            with self._lock:
+                self.conn.execute("DELETE FROM pending_roles")
+                (count,) = self.conn.execute("SELECT changes()").fetchone()
+                self._stats = None
+            return count
+        except Exception as e:
+            logger.exception(f"❌ Ошибка очистки БД: {e}")
+            return 0
 
 # ==================== 4. КОГ С ЛОГИКОЙ БОТА ====================
 class RoleManagerCog(commands.Cog):
     def __init__(self, bot: commands.Bot, db: Database):
         self.bot = bot
         self.db = db
-        self.check_expired_roles.start()
+        # guild_id -> (время выборки, {target_id: кто выдал отслеживаемую роль})
+        self._audit_cache: dict[int, tuple[float, dict]] = {}
+        # Планировщик спит до ближайшего истечения. Будить его при выдаче роли не нужно:
+        # новая запись истекает позже всех существующих и позже сна без записей
+        self._scheduler_task = None
+        self._next_check_at = None
+        # Сильные ссылки на фоновые задачи (ЛС), чтобы их не собрал GC до завершения
+        self._background_tasks: set[asyncio.Task] = set()
+        # guild_id -> есть ли у бота Manage Roles (обновляется по событиям Discord)
+        self._manage_roles_ok: dict[int, bool] = {}
+        # (guild_id, user_id), у которых роль снимает сама проверка: их запись удалит
+        # пакетный DELETE, а on_member_update не должен считать снятие ручным
+        self._expiring: set[tuple[int, int]] = set()
         logger.info(f"⚙️  Отслеживаем роль ID: {ROLE_ID_TO_TRACK}")
         logger.info(f"⏰ Снятие через {HOURS_UNTIL_REMOVAL} часов")
-        logger.info(f"🔄 Проверка каждые {CHECK_INTERVAL_MINUTES} минут")
+        logger.info(f"✉️  ЛС о снятии роли: {'включены' if SEND_DM_ON_REMOVE else 'выключены (DM_ON_REMOVE=1)'}")
+        logger.info(f"🔄 Проверка по времени ближайшего истечения (повтор ошибок: {RETRY_MIN_MINUTES}–{RETRY_MAX_MINUTES} минут)")
+    
+    async def cog_load(self):
+        self._scheduler_task = asyncio.create_task(self._scheduler())
+        self.optimize_db.start()
     
-    def cog_unload(self):
-        self.check_expired_roles.cancel()
+    async def cog_unload(self):
+        if self._scheduler_task:
+            self._scheduler_task.cancel()
+        self.optimize_db.cancel()
+        await asyncio.to_thread(self.db.checkpoint)
+    
+    @tasks.loop(hours=DB_OPTIMIZE_INTERVAL_HOURS)
+    async def optimize_db(self):
+        await asyncio.to_thread(self.db.optimize)
     
     @commands.Cog.listener()
     async def on_ready(self):
@@ -210,8 +407,7 @@ class RoleManagerCog(commands.Cog):
         logger.info(f"📊 Работает на {len(self.bot.guilds)} серверах")
         # Проверяем права бота на каждом сервере
         for guild in self.bot.guilds:
-            bot_member = guild.get_member(self.bot.user.id)
-            if bot_member and bot_member.guild_permissions.manage_roles:
+            if self._refresh_manage_roles(guild):
                 logger.info(f"✅ На сервере '{guild.name}' есть права Manage Roles")
             else:
                 logger.warning(f"⚠️  На сервере '{guild.name}' НЕТ прав Manage Roles — бот не сможет снимать роли!")
@@ -219,116 +415,278 @@ class RoleManagerCog(commands.Cog):
             activity=discord.Game(name=f"Слежу за ролью | !статус")
         )
     
+    def _refresh_manage_roles(self, guild: discord.Guild) -> bool:
+        bot_member = guild.get_member(self.bot.user.id)
+        ok = bool(bot_member and bot_member.guild_permissions.manage_roles)
+        self._manage_roles_ok[guild.id] = ok
+        return ok
+    
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: discord.Guild):
+        self._refresh_manage_roles(guild)
+    
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        # Записи сервера не удаляем: бота часто кикают и приглашают заново (например,
+        # чтобы выдать права), и роли должны сняться в срок. Если сервер ушёл насовсем,
+        # проверка удалит его записи при истечении
+        self._manage_roles_ok.pop(guild.id, None)
+    
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        self._refresh_manage_roles(after.guild)
+    
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member):
-        before_roles = set(r.id for r in before.roles)
-        after_roles = set(r.id for r in after.roles)
+        # Боту выдали/сняли роли — права могли измениться
+        if after.id == self.bot.user.id:
+            self._refresh_manage_roles(after.guild)
+        
+        # Быстрый выход: большинство обновлений (ник, аватар, другие роли) нас не касаются.
+        # Member.get_role — бинарный поиск по отсортированным ID, без построения множеств
+        had_role = before.get_role(ROLE_ID_TO_TRACK) is not None
+        has_role = after.get_role(ROLE_ID_TO_TRACK) is not None
+        if had_role == has_role:
+            return
         
         # Роль добавлена
-        if ROLE_ID_TO_TRACK in after_roles and ROLE_ID_TO_TRACK not in before_roles:
+        if has_role:
             assigner = "system/unknown"
             try:
-                async for entry in after.guild.audit_logs(limit=10, action=discord.AuditLogAction.member_role_update):
-                    if entry.target.id == after.id and hasattr(entry.after, 'roles'):
-                        after_roles_audit = [r.id for r in entry.after.roles]
-                        if ROLE_ID_TO_TRACK in after_roles_audit:
-                            assigner = f"{entry.user} (ID: {entry.user.id})"
-                            break
+                assigner = await self._find_assigner(after.guild, after.id) or assigner
             except discord.Forbidden:
                 logger.warning(f"⚠️  Нет прав на чтение Audit Log на сервере {after.guild.name}")
             except Exception as e:
                 logger.warning(f"⚠️  Ошибка чтения Audit Log: {e}")
             
-            self.db.add_role(after.id, after.guild.id, ROLE_ID_TO_TRACK, assigner)
-            logger.info(f"🎁 Роль выдана: {after} (ID: {after.id}) выдал: {assigner}")
+            await asyncio.to_thread(self.db.add_role, after.id, after.guild.id, ROLE_ID_TO_TRACK, assigner)
+            logger.info("🎁 Роль выдана: %s (ID: %s) выдал: %s", after, after.id, assigner)
         
         # Роль снята вручную
-        elif ROLE_ID_TO_TRACK in before_roles and ROLE_ID_TO_TRACK not in after_roles:
-            removed = self.db.remove_role_record(after.id, after.guild.id, ROLE_ID_TO_TRACK)
+        else:
+            # Кэшированный «кто выдал» относится к прошлой выдаче — при повторной
+            # выдаче в пределах TTL он приписал бы её не тому человеку
+            cached = self._audit_cache.get(after.guild.id)
+            if cached:
+                cached[1].pop(after.id, None)
+            if (after.guild.id, after.id) in self._expiring:
+                return
+            removed = await asyncio.to_thread(
+                self.db.remove_role_record, after.id, after.guild.id, ROLE_ID_TO_TRACK
+            )
             if removed:
-                logger.info(f"↩️  Роль снята вручную: {after} (ID: {after.id})")
+                logger.info("↩️  Роль снята вручную: %s (ID: %s)", after, after.id)
+    
+    @staticmethod
+    def _format_assigner(user):
+        return f"{user} (ID: {user.id})" if user else None
+    
+    async def _find_assigner(self, guild: discord.Guild, member_id: int):
+        """Ищет в Audit Log, кто выдал роль. Выборка кэшируется на сервер,
+        чтобы массовая выдача роли не делала HTTP-запрос на каждого участника."""
+        now = time.monotonic()
+        cached = self._audit_cache.get(guild.id)
+        if cached and now - cached[0] < AUDIT_CACHE_TTL_SECONDS and member_id in cached[1]:
+            return self._format_assigner(cached[1][member_id])
+        
+        # Кэш устарел или нужной записи в нём ещё нет — обновляем.
+        # Сохраняем только выдачи отслеживаемой роли; строку форматируем лишь для совпадения
+        granted_by = {}
+        async for entry in guild.audit_logs(limit=AUDIT_LOG_LIMIT, action=discord.AuditLogAction.member_role_update):
+            if entry.target is None or entry.target.id in granted_by:
+                continue  # записи идут от новых к старым — первая и есть актуальная
+            if any(r.id == ROLE_ID_TO_TRACK for r in getattr(entry.after, 'roles', ())):
+                granted_by[entry.target.id] = entry.user
+        self._audit_cache[guild.id] = (now, granted_by)
+        return self._format_assigner(granted_by.get(member_id))
+    
+    async def _fetch_missing_members(self, guild: discord.Guild, user_ids):
+        """Догружает в кэш участников, которых нет в guild.members (сервер ещё не прогружен).
+        Один gateway-запрос на 100 ID вместо REST-запроса на каждого участника"""
+        if guild.chunked:
+            return
+        missing = [uid for uid in set(user_ids) if guild.get_member(uid) is None]
+        for i in range(0, len(missing), MEMBER_QUERY_CHUNK):
+            chunk = missing[i:i + MEMBER_QUERY_CHUNK]
+            try:
+                await guild.query_members(user_ids=chunk, limit=len(chunk), cache=True)
+            except (asyncio.TimeoutError, discord.ClientException) as e:
+                logger.warning("⚠️  Не удалось догрузить участников сервера %s: %s", guild.name, e)
+                return
+    
+    async def _process_one(self, guild: discord.Guild, user_id: int, role: discord.Role,
+                           bot_top_role, semaphore: asyncio.Semaphore):
+        """Снимает одну истёкшую роль. role и bot_top_role уже найдены на уровне сервера.
+        Возвращает 'removed', 'stale' (запись неактуальна) или 'skipped' (запись оставляем)"""
+        member = guild.get_member(user_id)
+        if not member:
+            logger.warning("⚠️  Пользователь %s не на сервере %s — удаляем запись", user_id, guild.name)
+            return "stale"
+        
+        # Проверка: может ли бот снять эту роль?
+        if bot_top_role is not None and role >= bot_top_role:
+            logger.error(
+                "❌ Невозможно снять роль %s у %s — роль бота ниже или равна. "
+                "Роль бота: %s, роль цели: %s",
+                role.name, member, bot_top_role, role
+            )
+            return "skipped"
+        
+        # Снятие роли (семафор ограничивает число одновременных запросов к Discord)
+        async with semaphore:
+            self._expiring.add((guild.id, user_id))
+            await member.remove_roles(role, reason=f"Авто-снятие через {HOURS_UNTIL_REMOVAL}ч")
+        # На каждую запись — DEBUG; итог прохода пишется в INFO одной строкой
+        logger.debug("✅ Снята роль у %s (ID: %s)", member, member.id)
+        
+        # Уведомление в ЛС (если включено) — в фоне, чтобы не ждать ещё один HTTP-запрос
+        if SEND_DM_ON_REMOVE:
+            task = asyncio.create_task(self._send_dm_safe(member, role, guild))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+        return "removed"
+    
+    @staticmethod
+    async def _send_dm_safe(member: discord.Member, role: discord.Role, guild: discord.Guild):
+        try:
+            await member.send(
+                f"👋 Роль `{role.name}` на сервере **{guild.name}** автоматически снята "
+                f"спустя {HOURS_UNTIL_REMOVAL} часов после получения."
+            )
+        except (discord.Forbidden, discord.HTTPException):
+            logger.debug("✉️  Не удалось отправить ЛС пользователю %s", member.id)
+    
+    async def _scheduler(self):
+        """Вместо опроса по таймеру спим ровно до ближайшего истечения.
+        Большой бэклог разбирается пачками подряд, без сна: каждая пачка начинается
+        после последней записи предыдущей, так что записи с ошибками не загораживают остальные.
+        Если после полного прохода часть записей обработать не удалось — повторяем с растущим
+        интервалом (RETRY_MIN_MINUTES → RETRY_MAX_MINUTES), чтобы не долбить Discord одной и той же ошибкой."""
+        await self.bot.wait_until_ready()
+        logger.debug("✅ Фоновая задача готова к работе")
+        retry_delay = RETRY_MIN_MINUTES * 60
+        while True:
+            # Один порог на весь проход, иначе постраничная выборка поплывёт
+            cutoff = int(time.time()) - HOURS_UNTIL_REMOVAL * 3600
+            leftover = 0
+            after = (-1, 0)
+            while after is not None:
+                batch_leftover, after = await self.check_expired_roles(cutoff, after)
+                leftover += batch_leftover
+            
+            next_expiry = await asyncio.to_thread(self.db.get_next_expiry, cutoff, HOURS_UNTIL_REMOVAL)
+            delay = IDLE_SLEEP_HOURS * 3600 if next_expiry is None else next_expiry - time.time()
+            if leftover:
+                delay = min(delay, retry_delay)
+                retry_delay = min(retry_delay * 2, RETRY_MAX_MINUTES * 60)
+            else:
+                retry_delay = RETRY_MIN_MINUTES * 60
+            delay = max(1, delay)
+            self._next_check_at = int(time.time() + delay)
+            logger.debug("💤 Следующая проверка через %d с", delay)
+            
+            await asyncio.sleep(delay)
     
-    @tasks.loop(minutes=CHECK_INTERVAL_MINUTES)
-    async def check_expired_roles(self):
-        """ПОЛНОСТЬЮ ЗАЩИЩЁННАЯ задача с обработкой ВСЕХ ошибок"""
+    async def check_expired_roles(self, cutoff: int, after=(-1, 0)):
+        """ПОЛНОСТЬЮ ЗАЩИЩЁННАЯ проверка одной пачки с обработкой ВСЕХ ошибок.
+        Возвращает (число истёкших записей пачки, оставшихся в БД;
+        ключ (assigned_at, rowid) для следующей пачки или None, если пачка последняя)"""
         try:
             logger.debug("🔍 Запуск проверки истёкших ролей...")
-            expired = self.db.get_expired_roles(hours=HOURS_UNTIL_REMOVAL)
+            expired = await asyncio.to_thread(
+                self.db.get_expired_roles, cutoff, after, limit=EXPIRED_BATCH_LIMIT
+            )
             
             if not expired:
                 logger.debug("✅ Нет ролей для снятия")
-                return
+                return 0, None
             
-            logger.info(f"⏰ Обнаружено {len(expired)} ролей для снятия (старше {HOURS_UNTIL_REMOVAL}ч)")
+            logger.info("⏰ Обнаружено %d ролей для снятия (старше %dч)", len(expired), HOURS_UNTIL_REMOVAL)
             processed = 0
             errors = 0
+            # rowid обработанных записей копим и удаляем из БД одним запросом в конце
+            done = []
             
-            for user_id, guild_id, role_id, assigned_at, assigned_by in expired:
-                try:
-                    guild = self.bot.get_guild(guild_id)
-                    if not guild:
-                        logger.warning(f"⚠️  Сервер {guild_id} не найден — удаляем запись")
-                        self.db.remove_role_record(user_id, guild_id, role_id)
-                        continue
-                    
-                    member = guild.get_member(user_id)
-                    if not member:
-                        logger.warning(f"⚠️  Пользователь {user_id} не на сервере {guild.name} — удаляем запись")
-                        self.db.remove_role_record(user_id, guild_id, role_id)
-                        continue
-                    
-                    role = guild.get_role(role_id)
+            # Группируем по серверу, чтобы искать каждый сервер один раз
+            by_guild: dict[int, list] = {}
+            for rowid, user_id, guild_id, role_id, assigned_at, assigned_by in expired:
+                by_guild.setdefault(guild_id, []).append((rowid, user_id, role_id))
+            
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_REMOVALS)
+            keys = []
+            jobs = []
+            for guild_id, records in by_guild.items():
+                guild = self.bot.get_guild(guild_id)
+                if not guild:
+                    logger.warning("⚠️  Сервер %s не найден — удаляем %d записей", guild_id, len(records))
+                    done.extend(rowid for rowid, user_id, role_id in records)
+                    continue
+                
+                # Без Manage Roles каждый запрос вернёт 403 — не тратим на них API,
+                # записи остаются до следующего прохода
+                manage_roles_ok = self._manage_roles_ok.get(guild_id)
+                if manage_roles_ok is None:
+                    manage_roles_ok = self._refresh_manage_roles(guild)
+                if not manage_roles_ok:
+                    logger.warning("⚠️  Нет прав Manage Roles на сервере %s — пропускаем %d записей", guild.name, len(records))
+                    continue
+                
+                # Бот и роли ищутся один раз на сервер, а не на каждую запись
+                bot_member = guild.get_member(self.bot.user.id)
+                bot_top_role = bot_member.top_role if bot_member else None
+                roles: dict[int, discord.Role] = {}
+                await self._fetch_missing_members(guild, (user_id for _, user_id, _ in records))
+                
+                for rowid, user_id, role_id in records:
+                    if role_id not in roles:
+                        roles[role_id] = guild.get_role(role_id)
+                    role = roles[role_id]
                     if not role:
-                        logger.warning(f"⚠️  Роль {role_id} не найдена на сервере {guild.name} — удаляем запись")
-                        self.db.remove_role_record(user_id, guild_id, role_id)
-                        continue
-                    
-                    # Проверка: может ли бот снять эту роль?
-                    bot_member = guild.get_member(self.bot.user.id)
-                    if bot_member and role >= bot_member.top_role:
-                        logger.error(
-                            f"❌ Невозможно снять роль {role.name} у {member} — роль бота ниже или равна. "
-                            f"Роль бота: {bot_member.top_role}, роль цели: {role}"
-                        )
+                        logger.warning("⚠️  Роль %s не найдена на сервере %s — удаляем запись", role_id, guild.name)
+                        done.append(rowid)
                         continue
-                    
-                    # Снятие роли
-                    await member.remove_roles(role, reason=f"Авто-снятие через {HOURS_UNTIL_REMOVAL}ч")
-                    self.db.remove_role_record(user_id, guild_id, role_id)
-                    processed += 1
-                    logger.info(f"✅ Снята роль у {member} (ID: {member.id})")
-                    
-                    # Уведомление в ЛС
-                    try:
-                        await member.send(
-                            f"👋 Роль `{role.name}` на сервере **{guild.name}** автоматически снята "
-                            f"спустя {HOURS_UNTIL_REMOVAL} часов после получения."
-                        )
-                    except (discord.Forbidden, discord.HTTPException):
-                        logger.debug(f"✉️  Не удалось отправить ЛС пользователю {member.id}")
-                
-                except discord.Forbidden as e:
+                    keys.append((rowid, user_id, guild_id))
+                    jobs.append(self._process_one(guild, user_id, role, bot_top_role, semaphore))
+            
+            results = await asyncio.gather(*jobs, return_exceptions=True)
+            
+            for (rowid, user_id, guild_id), result in zip(keys, results):
+                if isinstance(result, discord.Forbidden):
                     errors += 1
-                    logger.error(f"❌ Нет прав для снятия роли у {user_id} на сервере {guild_id}: {e}")
-                except Exception as e:
+                    logger.error("❌ Нет прав для снятия роли у %s на сервере %s: %s", user_id, guild_id, result)
+                elif isinstance(result, BaseException):
                     errors += 1
-                    logger.exception(f"❌ Ошибка при обработке записи (user={user_id}, guild={guild_id}): {e}")
+                    logger.error(
+                        "❌ Ошибка при обработке записи (user=%s, guild=%s): %s",
+                        user_id, guild_id, result, exc_info=result
+                    )
+                elif result != "skipped":
+                    done.append(rowid)
+                    if result == "removed":
+                        processed += 1
             
-            logger.info(f"✅ Завершена проверка: обработано {processed}, ошибок {errors} из {len(expired)} записей")
+            await asyncio.to_thread(self.db.remove_expired_rows, done, HOURS_UNTIL_REMOVAL)
+            # Запоздавшие события найдут запись уже удалённой и ничего не сделают
+            self._expiring.clear()
+            logger.info(
+                "✅ Завершена проверка: обработано %d, ошибок %d из %d записей",
+                processed, errors, len(expired)
+            )
+            # Пачка полная — за ней могут быть ещё записи, продолжаем с последней строки
+            last = expired[-1]
+            next_after = (last[4], last[0]) if len(expired) == EXPIRED_BATCH_LIMIT else None
+            return len(expired) - len(done), next_after
         
         except Exception as e:
             logger.exception(f"🔥 КРИТИЧЕСКАЯ ОШИБКА в задаче check_expired_roles: {e}")
-    
-    @check_expired_roles.before_loop
-    async def before_check(self):
-        await self.bot.wait_until_ready()
-        logger.debug("✅ Фоновая задача готова к работе")
+            self._expiring.clear()
+            return 1, None
     
     # ==================== 5. КОМАНДЫ ДЛЯ АДМИНИСТРАТОРА ====================
     @commands.command(name="статус", aliases=["status", "info"])
     @commands.has_permissions(administrator=True)
     async def status(self, ctx: commands.Context):
-        count, oldest = self.db.get_all_pending()
+        count, oldest = await asyncio.to_thread(self.db.get_all_pending)
         
         embed = discord.Embed(
             title="📊 Статус бота управления ролями",
@@ -338,27 +696,24 @@ class RoleManagerCog(commands.Cog):
         embed.add_field(name="Отслеживаемая роль", value=f"<@&{ROLE_ID_TO_TRACK}> (ID: {ROLE_ID_TO_TRACK})", inline=False)
         embed.add_field(name="Активных записей", value=f"{count} пользователей", inline=True)
         embed.add_field(name="Снятие через", value=f"{HOURS_UNTIL_REMOVAL} часов", inline=True)
-        embed.add_field(name="Проверка каждые", value=f"{CHECK_INTERVAL_MINUTES} минут", inline=True)
+        if self._next_check_at:
+            embed.add_field(name="Следующая проверка", value=f"<t:{self._next_check_at}:R>", inline=True)
         
-        if oldest and count > 0:
-            try:
-                clean_date = oldest.replace("Z", "+00:00") if "Z" in oldest else oldest
-                assigned_dt = datetime.fromisoformat(clean_date)
-                delta = datetime.now(timezone.utc) - assigned_dt
-                hours = int(delta.total_seconds() // 3600)
-                minutes = int((delta.total_seconds() % 3600) // 60)
-                embed.add_field(
-                    name="Самая старая запись", 
-                    value=f"{hours}ч {minutes}м назад", 
-                    inline=False
-                )
-            except Exception as e:
-                logger.warning(f"⚠️  Ошибка парсинга даты '{oldest}': {e}")
-                embed.add_field(name="Самая старая запись", value="ошибка парсинга", inline=False)
+        if oldest is not None and count > 0:
+            delta_s = max(0, int(time.time()) - oldest)
+            hours = delta_s // 3600
+            minutes = (delta_s % 3600) // 60
+            embed.add_field(
+                name="Самая старая запись", 
+                value=f"{hours}ч {minutes}м назад", 
+                inline=False
+            )
         
-        # Проверка прав бота
-        bot_member = ctx.guild.get_member(self.bot.user.id)
-        if bot_member and bot_member.guild_permissions.manage_roles:
+        # Проверка прав бота (значение кэшируется и обновляется по событиям)
+        manage_roles_ok = self._manage_roles_ok.get(ctx.guild.id)
+        if manage_roles_ok is None:
+            manage_roles_ok = self._refresh_manage_roles(ctx.guild)
+        if manage_roles_ok:
             perms_status = "✅ Есть"
         else:
             perms_status = "❌ Нет"
@@ -370,12 +725,7 @@ class RoleManagerCog(commands.Cog):
     @commands.command(name="очистить", aliases=["clear"])
     @commands.has_permissions(administrator=True)
     async def clear_db(self, ctx: commands.Context):
-        conn = sqlite3.connect(self.db.path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM pending_roles")
-        count = cursor.rowcount
-        conn.commit()
-        conn.close()
+        count = await asyncio.to_thread(self.db.clear_all)
         await ctx.send(f"✅ Очищено {count} записей из базы данных")
         logger.warning(f"🧹 Администратор {ctx.author} очистил базу данных ({count} записей)")
 
@@ -383,17 +733,12 @@ class RoleManagerCog(commands.Cog):
 def main():
     TOKEN = os.getenv("DISCORD_TOKEN")
     if not TOKEN:
-        print("❌ Не найдена переменная окружения DISCORD_TOKEN", file=sys.stderr)
+        logger.error("❌ Не найдена переменная окружения DISCORD_TOKEN")
         sys.exit(1)
     
     logger.info("🚀 Инициализация базы данных...")
     db = Database()
     
-    # Запускаем health check сервер ДО бота (в отдельном потоке)
-    health_thread = threading.Thread(target=start_health_server, daemon=True)
-    health_thread.start()
-    logger.info("✅ Health check сервер запущен на порту 8000 (/health)")
-    
     intents = discord.Intents.default()
     intents.members = True
     intents.message_content = True
@@ -402,7 +747,8 @@ def main():
         command_prefix="!",
         intents=intents,
         help_command=None,
-        case_insensitive=True
+        case_insensitive=True,
+        chunk_guilds_at_startup=True    # Участники в кэше — get_member без REST-запросов
     )
     
     @bot.event
@@ -412,7 +758,7 @@ def main():
         elif isinstance(error, commands.CommandNotFound):
             pass
         else:
-            logger.exception(f"Ошибка команды: {e}")
+            logger.error("❌ Ошибка команды %s: %s", ctx.command, error, exc_info=error)
             await ctx.send("❌ Произошла внутренняя ошибка при выполнении команды")
     
     @bot.command()
@@ -423,15 +769,30 @@ def main():
     async def on_ready():
         await bot.add_cog(RoleManagerCog(bot, db))
     
+    async def run_bot():
+        # Health check сервер поднимаем ДО бота: Render ждёт открытый порт,
+        # а вход в Discord может затянуться (429 на общих IP)
+        runner = await start_health_server()
+        try:
+            async with bot:
+                await bot.start(TOKEN)
+        finally:
+            if runner:
+                await runner.cleanup()
+    
     try:
         logger.info("🚀 Запуск бота...")
-        bot.run(TOKEN, log_handler=None)
+        asyncio.run(run_bot())
+    except KeyboardInterrupt:
+        logger.info("🛑 Бот остановлен")
     except discord.LoginFailure:
         logger.error("❌ Неверный токен бота. Проверьте DISCORD_TOKEN")
         sys.exit(1)
     except Exception as e:
         logger.exception(f"❌ Критическая ошибка при запуске: {e}")
         sys.exit(1)
+    finally:
+        db.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file